@@ -1,15 +1,23 @@
 import os
-import json
+import copy
 import time
 import uuid
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from fractions import Fraction
-from typing import Any, Dict, Tuple, Optional
+from typing import Any, Dict, List, Tuple, Optional
 
 import boto3
+import orjson
 import requests
 import runpod
+import urllib3
+import websocket
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # -----------------------------
@@ -18,18 +26,81 @@ import runpod
 COMFY_HOST = os.environ.get("COMFY_HOST", "127.0.0.1")
 COMFY_PORT = int(os.environ.get("COMFYUI_PORT") or os.environ.get("COMFY_PORT") or "8188")
 COMFY_BASE = f"http://{COMFY_HOST}:{COMFY_PORT}"
+COMFY_WS = f"ws://{COMFY_HOST}:{COMFY_PORT}/ws"
+
+# ComfyUI 调用共用一个 keep-alive Session（/prompt、/history 轮询复用 TCP 连接）
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504]),
+))
 
 S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
 S3_BUCKET = os.environ.get("S3_BUCKET")
 S3_ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID")
 S3_SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY")
 
+# S3 传输：大文件走并发分片（ranged GET / multipart upload），避免单连接限速
+S3_MULTIPART_THRESHOLD = 8 << 20
+S3_MULTIPART_CHUNKSIZE = 16 << 20
+S3_MAX_CONCURRENCY = 10
+_TC = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+    use_threads=True,
+)
+
+# 预签名 URL 直连下载用的连接池（每个分片一个连接）
+# urllib3 默认不超时：分片卡住会让 ex.map 永远等下去，回退到 download_file 也走不到
+_HTTP = urllib3.PoolManager(
+    maxsize=S3_MAX_CONCURRENCY,
+    timeout=urllib3.Timeout(connect=10, read=60),
+    retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+)
+
 # 你的策略（按你最新要求）
 FPS_CAP = 30          # 只要输入 fps > 30 才降到 30
 MAX_SECONDS = 15      # 只要时长 > 15 秒才裁剪到前 15 秒
 
+# 需要降帧时让 ffmpeg 直接读预签名 URL（下载与转码融合，输入不落盘）；默认关闭
+PREPROCESS_STREAMING = os.environ.get("PREPROCESS_STREAMING", "0") == "1"
+
+# 降帧需要重编码：有 GPU 时用 NVENC，否则 libx264
+# libx264 针对 ≤15 秒短片段偏向低延迟：切片多线程、短 lookahead、无 B 帧
+# 每个线程就是一个 slice：按本进程可用 CPU 计（容器里 cpu_count() 是宿主机核数），最多 8 个，避免切片过碎损失画质/码率
+_X264_THREADS = min(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1), 8)
+X264_VIDEO_ARGS = [
+    "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p",
+    "-threads", str(_X264_THREADS),
+    "-x264-params", "sliced-threads=1:rc-lookahead=10:bframes=0",
+]
+NVENC_VIDEO_ARGS = [
+    "-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq",
+    "-rc", "vbr", "-cq", "20", "-b:v", "0", "-pix_fmt", "yuv420p",
+]
+
+# job 工作目录：空间够时放 tmpfs（下载/ffmpeg 读写都走内存），否则落盘
+JOBS_SHM_ROOT = "/dev/shm/jobs"
+JOBS_DISK_ROOT = "/tmp/jobs"
+
 WORKFLOW_PATH = "/comfyui/workflows/workflow_api.json"
 COMFY_OUTPUT_DIR = "/comfyui/output"
+PLACEHOLDERS = ("__INPUT_VIDEO__", "__OUTPUT_PREFIX__")
+
+# 冷启动预热：接单前先跑一次极小的合成视频，让模型权重常驻（COMFY_WARMUP=0 关闭）
+COMFY_WARMUP = os.environ.get("COMFY_WARMUP", "1") != "0"
+WARMUP_TIMEOUT_SEC = int(os.environ.get("WARMUP_TIMEOUT_SEC", "600"))
+
+# warm worker 复用进程：S3 client / workflow 模板只初始化一次
+_S3 = None
+_WF_TEMPLATE = None
+_WF_PATCHES = None
+_NVENC = None
+
+# 后台 IO（下载/预读 workflow/预热/上传），跨 job 复用线程
+_EX = ThreadPoolExecutor(max_workers=4)
 
 
 # -----------------------------
@@ -40,41 +111,84 @@ def _require_env(name: str, val: Optional[str]):
         raise RuntimeError(f"Missing env var: {name}")
 
 
-def deep_replace(obj: Any, mapping: Dict[str, str]) -> Any:
-    """Recursively replace placeholder strings inside JSON-like structure."""
-    if isinstance(obj, dict):
-        return {k: deep_replace(v, mapping) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [deep_replace(v, mapping) for v in obj]
-    if isinstance(obj, str):
+def compile_patches(obj: Any, placeholders: Tuple[str, ...]) -> List[Tuple[tuple, str]]:
+    """Scan a JSON-like structure once; return [(key_path, template_string)] for leaves containing a placeholder."""
+    patches = []
+
+    def rec(o: Any, path: tuple):
+        if isinstance(o, dict):
+            for k, v in o.items():
+                rec(v, path + (k,))
+        elif isinstance(o, list):
+            for i, v in enumerate(o):
+                rec(v, path + (i,))
+        elif isinstance(o, str) and any(p in o for p in placeholders):
+            patches.append((path, o))
+
+    rec(obj, ())
+    return patches
+
+
+def apply_patches(template: Any, patches: List[Tuple[tuple, str]], mapping: Dict[str, str]) -> Any:
+    """
+    Substitute placeholders only at the precompiled paths.
+    Containers along those paths are shallow-copied; everything else is shared with the template,
+    so the template itself is never mutated.
+    """
+    root = copy.copy(template)
+    copied = {id(root)}
+    for path, text in patches:
+        node = root
+        for key in path[:-1]:
+            child = node[key]
+            if id(child) not in copied:
+                child = copy.copy(child)
+                node[key] = child
+                copied.add(id(child))
+            node = child
         for k, v in mapping.items():
-            obj = obj.replace(k, v)
-        return obj
-    return obj
+            text = text.replace(k, v)
+        node[path[-1]] = text
+    return root
+
+
+# (fps, duration_seconds, audio_codec)
+VideoProbe = Tuple[Optional[float], Optional[float], Optional[str]]
 
 
 def sh(cmd: list, check: bool = True) -> str:
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # close_fds=False 让 subprocess 走 vfork/posix_spawn，不必逐个关闭 boto3/requests 打开的 socket
+    p = subprocess.run(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        close_fds=False,
+    )
     if check and p.returncode != 0:
         raise RuntimeError(f"Command failed: {cmd}\nSTDERR:\n{p.stderr}")
     return p.stdout.strip()
 
 
-def probe_video(path: str) -> Tuple[Optional[float], Optional[float]]:
-    """Returns (fps, duration_seconds) using ffprobe."""
+def probe_video(path: str) -> VideoProbe:
+    """Returns (fps, duration_seconds, audio_codec) using ffprobe. audio_codec is None when there is no audio."""
+    # mp4/mov 的 fps/时长/编码直接来自 moov 头，小 probesize 即可，省去探测启动开销
     out = sh([
-        "ffprobe", "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=avg_frame_rate,r_frame_rate",
+        "ffprobe", "-hide_banner", "-v", "error",
+        "-probesize", "32k",
+        "-analyzeduration", "100000",
+        "-show_entries", "stream=codec_type,codec_name,avg_frame_rate,r_frame_rate",
         "-show_entries", "format=duration",
         "-of", "json",
         path
     ])
     try:
-        data = json.loads(out)
+        data = orjson.loads(out)
+        streams = data.get("streams") or []
 
         fps = None
-        stream = (data.get("streams") or [{}])[0]
+        stream = next((st for st in streams if st.get("codec_type") == "video"), {})
         afr = stream.get("avg_frame_rate") or "0/0"
         rfr = stream.get("r_frame_rate") or "0/0"
         for frac in (afr, rfr):
@@ -86,6 +200,8 @@ def probe_video(path: str) -> Tuple[Optional[float], Optional[float]]:
             except Exception:
                 pass
 
+        acodec = next((st.get("codec_name") for st in streams if st.get("codec_type") == "audio"), None)
+
         dur = None
         fmt = data.get("format") or {}
         if fmt.get("duration") is not None:
@@ -94,80 +210,167 @@ def probe_video(path: str) -> Tuple[Optional[float], Optional[float]]:
             except Exception:
                 dur = None
 
-        return fps, dur
+        return fps, dur, acodec
     except Exception:
-        return None, None
+        return None, None, None
 
 
-def ffmpeg_trim_copy(src: str, dst: str, max_seconds: int) -> Dict[str, Any]:
+def run_ffmpeg(args: list) -> Optional[float]:
+    """
+    Run ffmpeg with -progress on stdout.
+    Returns the output duration (seconds) reported by ffmpeg itself, so no post-ffprobe is needed.
+    """
+    out = sh(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-nostats", "-progress", "pipe:1"] + args, check=True)
+    dur = None
+    for line in out.splitlines():
+        key, _, val = line.partition("=")
+        if key == "out_time_us":
+            try:
+                dur = int(val) / 1_000_000
+            except ValueError:
+                pass
+    return dur
+
+
+def ffmpeg_trim_copy(src: str, dst: str, max_seconds: int, fps_in: Optional[float] = None) -> Dict[str, Any]:
     """
     Trim to first max_seconds with stream copy (no re-encode).
-    Keeps quality.
+    Keeps quality. -t is an input option so the demuxer stops reading at max_seconds.
     """
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", src,
+    dur_out = run_ffmpeg([
         "-t", str(int(max_seconds)),
+        "-i", src,
         "-c", "copy",
         "-movflags", "+faststart",
         "-avoid_negative_ts", "make_zero",
         dst
-    ]
-    sh(cmd, check=True)
-    fps_out, dur_out = probe_video(dst)
-    return {"path": dst, "fps_out": fps_out, "dur_out": dur_out, "transcoded": False, "remuxed": True}
-
+    ])
+    return {"path": dst, "fps_out": fps_in, "dur_out": dur_out, "transcoded": False, "remuxed": True}
 
-def ffmpeg_downsample_encode(src: str, dst: str, fps_cap: int, max_seconds: Optional[int]) -> Dict[str, Any]:
-    """
-    Downsample fps (requires re-encode). Optionally trim.
-    Try audio copy first; fallback to AAC if needed.
-    """
-    base = ["ffmpeg", "-y", "-i", src]
-    if max_seconds and max_seconds > 0:
-        base += ["-t", str(int(max_seconds))]
 
-    base += ["-vf", f"fps={int(fps_cap)}"]
+def pick_jobs_root(need_bytes: int) -> str:
+    """/dev/shm when it has more than need_bytes free, else /tmp."""
+    try:
+        st = os.statvfs("/dev/shm")
+        if st.f_bavail * st.f_frsize > need_bytes:
+            return JOBS_SHM_ROOT
+    except OSError:
+        pass
+    return JOBS_DISK_ROOT
 
-    # Try audio copy first
-    cmd1 = base + [
-        "-c:v", "libx264",
-        "-preset", "veryfast",
-        "-crf", "18",
-        "-pix_fmt", "yuv420p",
-        "-c:a", "copy",
-        "-movflags", "+faststart",
-        dst
-    ]
 
+def cleanup_workdir(workdir: str, files: Tuple[str, ...]):
+    """The workdir is flat with known files: unlink them directly; rmtree only if something unexpected is left."""
+    for p in files:
+        try:
+            os.unlink(p)
+        except FileNotFoundError:
+            pass
     try:
-        sh(cmd1, check=True)
-    except Exception:
-        cmd2 = base + [
-            "-c:v", "libx264",
-            "-preset", "veryfast",
-            "-crf", "18",
-            "-pix_fmt", "yuv420p",
-            "-c:a", "aac",
-            "-b:a", "192k",
+        os.rmdir(workdir)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _nvenc_available() -> bool:
+    """GPU present and ffmpeg built with h264_nvenc; checked once per process."""
+    global _NVENC
+    if _NVENC is None:
+        _NVENC = False
+        if shutil.which("nvidia-smi"):
+            try:
+                _NVENC = "h264_nvenc" in sh(["ffmpeg", "-hide_banner", "-encoders"], check=False)
+            except Exception:
+                _NVENC = False
+    return _NVENC
+
+
+def _disable_nvenc(err: Exception) -> None:
+    """
+    First NVENC run failed (e.g. driver without the `video` capability): stop trying it for
+    the rest of the process so later jobs go straight to libx264. Logged once.
+    """
+    global _NVENC
+    if _NVENC:
+        _NVENC = False
+        print(f"[NVENC] disabled after failure, using libx264: {err}", flush=True)
+
+
+def ffmpeg_downsample_encode(
+    src: str,
+    dst: str,
+    fps_cap: int,
+    max_seconds: Optional[int],
+    audio_codec: Optional[str] = None,
+    input_args: Optional[list] = None,
+) -> Dict[str, Any]:
+    """
+    Downsample fps (requires re-encode). Optionally trim (input-side -t, so demux stops at max_seconds).
+    Encode on NVENC when available, else libx264; if an encoder run fails, fall back to the next one.
+    Audio is chosen from the probed codec in one pass: AAC/MP3/Opus are copied, anything else is encoded to AAC.
+    input_args go right before -i (e.g. http reconnect options when src is a URL).
+    """
+    pre_input = list(input_args or [])
+    if max_seconds and max_seconds > 0:
+        pre_input += ["-t", str(int(max_seconds))]
+
+    encoders = []
+    if _nvenc_available():
+        encoders.append(("h264_nvenc", ["-hwaccel", "cuda"], NVENC_VIDEO_ARGS))
+    encoders.append(("libx264", [], X264_VIDEO_ARGS))
+
+    if audio_codec is None:
+        audio_args = ["-an"]
+    elif audio_codec == "aac":
+        audio_args = ["-c:a", "copy", "-bsf:a", "aac_adtstoasc"]
+    elif audio_codec in ("mp3", "opus"):
+        audio_args = ["-c:a", "copy"]
+    else:
+        audio_args = ["-c:a", "aac", "-b:a", "192k"]
+
+    last_err = None
+    for encoder, hw_args, video_args in encoders:
+        cmd = hw_args + pre_input + ["-i", src] + ["-vf", f"fps=fps={int(fps_cap)}:round=down"] + video_args + audio_args + [
             "-movflags", "+faststart",
             dst
         ]
-        sh(cmd2, check=True)
-
-    fps_out, dur_out = probe_video(dst)
-    return {"path": dst, "fps_out": fps_out, "dur_out": dur_out, "transcoded": True, "remuxed": False}
+        try:
+            dur_out = run_ffmpeg(cmd)
+        except Exception as e:
+            last_err = e
+            if encoder == "h264_nvenc":
+                _disable_nvenc(e)
+            continue
+        return {
+            "path": dst,
+            "fps_out": float(fps_cap),
+            "dur_out": dur_out,
+            "transcoded": True,
+            "remuxed": False,
+            "encoder": encoder,
+        }
+    raise last_err
 
 
-def preprocess_video(src: str, dst: str, fps_cap: int, max_seconds: int) -> Dict[str, Any]:
+def preprocess_video(
+    src: str,
+    dst: str,
+    fps_cap: int,
+    max_seconds: int,
+    probe: Optional[VideoProbe] = None,
+    input_args: Optional[list] = None,
+) -> Dict[str, Any]:
     """
     Rules:
     - if fps_in > FPS_CAP -> downsample to FPS_CAP (re-encode)
     - if dur_in > MAX_SECONDS -> trim to MAX_SECONDS
-    - if only trim needed -> stream copy (no re-encode)
+    - if only trim needed -> stream copy (no re-encode); libx264 only runs when fps must drop
     - if nothing needed -> use src directly
+    probe: probe_video result if src was already probed.
     """
-    fps_in, dur_in = probe_video(src)
+    fps_in, dur_in, acodec_in = probe if probe is not None else probe_video(src)
 
     need_fps = (fps_in is not None and fps_in > (fps_cap + 0.01))
     need_trim = (dur_in is not None and dur_in > (max_seconds + 0.001))
@@ -175,12 +378,15 @@ def preprocess_video(src: str, dst: str, fps_cap: int, max_seconds: int) -> Dict
     info = {
         "fps_in": fps_in,
         "dur_in": dur_in,
+        "audio_codec_in": acodec_in,
         "fps_cap": fps_cap,
         "max_seconds": max_seconds,
         "downsampled": False,
         "trimmed": False,
         "transcoded": False,
         "remuxed": False,
+        "encoder": None,
+        "streamed": False,
         "path": src
     }
 
@@ -189,13 +395,19 @@ def preprocess_video(src: str, dst: str, fps_cap: int, max_seconds: int) -> Dict
 
     # only trim -> no re-encode
     if need_trim and not need_fps:
-        out = ffmpeg_trim_copy(src, dst, max_seconds=max_seconds)
+        out = ffmpeg_trim_copy(src, dst, max_seconds=max_seconds, fps_in=fps_in)
         info.update(out)
         info["trimmed"] = True
         return info
 
     # need fps downsample -> re-encode (and trim if needed)
-    out = ffmpeg_downsample_encode(src, dst, fps_cap=fps_cap, max_seconds=(max_seconds if need_trim else None))
+    out = ffmpeg_downsample_encode(
+        src, dst,
+        fps_cap=fps_cap,
+        max_seconds=(max_seconds if need_trim else None),
+        audio_codec=acodec_in,
+        input_args=input_args,
+    )
     info.update(out)
     info["downsampled"] = True
     info["transcoded"] = True
@@ -204,19 +416,161 @@ def preprocess_video(src: str, dst: str, fps_cap: int, max_seconds: int) -> Dict
     return info
 
 
-def comfy_post_prompt(prompt: dict) -> str:
-    r = requests.post(f"{COMFY_BASE}/prompt", json={"prompt": prompt}, timeout=60)
+def _get_s3():
+    global _S3
+    if _S3 is None:
+        _S3 = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=S3_ACCESS_KEY_ID,
+            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+            config=BotoConfig(
+                signature_version="s3v4",
+                max_pool_connections=50,
+                retries={"max_attempts": 10, "mode": "adaptive"},
+            ),
+        )
+    return _S3
+
+
+def download_ranged(s3, bucket: str, key: str, dst: str, size: Optional[int] = None) -> int:
+    """
+    Download via a presigned URL with concurrent ranged GETs, each written in place with os.pwrite.
+    Falls back to boto3 download_file if the direct path fails. Returns the object size.
+    size: ContentLength if the caller already issued head_object.
+    """
+    if size is None:
+        size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    try:
+        url = s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=900)
+        ranges = [
+            (start, min(start + S3_MULTIPART_CHUNKSIZE, size) - 1)
+            for start in range(0, size, S3_MULTIPART_CHUNKSIZE)
+        ]
+        fd = os.open(dst, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            def fetch(rng: Tuple[int, int]):
+                start, end = rng
+                r = _HTTP.request("GET", url, headers={"Range": f"bytes={start}-{end}"}, preload_content=False)
+                try:
+                    if r.status != 206 and not (r.status == 200 and start == 0 and end == size - 1):
+                        raise RuntimeError(f"Ranged GET failed: status={r.status} range={start}-{end}")
+                    off = start
+                    for chunk in r.stream(1 << 20):
+                        view = memoryview(chunk)
+                        while view:
+                            n = os.pwrite(fd, view, off)
+                            view = view[n:]
+                            off += n
+                    if off != end + 1:
+                        raise RuntimeError(f"Short read: got {off - start} of {end - start + 1} bytes at {start}")
+                finally:
+                    r.release_conn()
+
+            with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as ex:
+                list(ex.map(fetch, ranges))
+        finally:
+            os.close(fd)
+    except Exception:
+        s3.download_file(bucket, key, dst, Config=_TC)
+    return size
+
+
+def stream_preprocess(
+    s3, bucket: str, key: str, dst: str, fps_cap: int, max_seconds: int
+) -> Tuple[Optional[Dict[str, Any]], Optional[VideoProbe]]:
+    """
+    Fused download+preprocess for the re-encode case: ffprobe/ffmpeg read the presigned URL directly,
+    so encoding starts while bytes arrive and the full input is never written to disk.
+    HTTP range requests keep the input seekable (mp4 with moov at the end still works; a stdin pipe would not).
+    Returns (info, probe); info is None when no re-encode is needed (stream copy / passthrough use the
+    downloaded file) or when streaming failed (caller downloads and preprocesses as usual).
+    """
+    try:
+        url = s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=3600)
+        probe = probe_video(url)
+    except Exception:
+        return None, None
+
+    fps_in = probe[0]
+    if fps_in is None or fps_in <= (fps_cap + 0.01):
+        return None, probe
+
+    try:
+        info = preprocess_video(url, dst, fps_cap=fps_cap, max_seconds=max_seconds, probe=probe,
+                                input_args=["-reconnect", "1"])
+    except Exception:
+        return None, probe
+    info["streamed"] = True
+    return info, probe
+
+
+def load_workflow() -> dict:
+    with open(WORKFLOW_PATH, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def _get_workflow() -> Tuple[dict, List[Tuple[tuple, str]]]:
+    """Cached (template, placeholder patches). Treat the template as read-only; use apply_patches per job."""
+    global _WF_TEMPLATE, _WF_PATCHES
+    if _WF_TEMPLATE is None:
+        wf = load_workflow()
+        _WF_PATCHES = compile_patches(wf, PLACEHOLDERS)
+        _WF_TEMPLATE = wf
+    return _WF_TEMPLATE, _WF_PATCHES
+
+
+def comfy_ping() -> bool:
+    """Warm up the ComfyUI connection; failures are non-fatal."""
+    try:
+        r = _SESSION.get(f"{COMFY_BASE}/system_stats", timeout=2)
+        return r.ok
+    except Exception:
+        return False
+
+
+def comfy_connect_ws(client_id: str) -> Optional[websocket.WebSocket]:
+    """Open the ComfyUI event socket; None if unavailable (caller falls back to history polling)."""
+    try:
+        return websocket.create_connection(f"{COMFY_WS}?clientId={client_id}", timeout=10)
+    except Exception:
+        return None
+
+
+def comfy_post_prompt(prompt: dict, client_id: Optional[str] = None) -> str:
+    body = {"prompt": prompt}
+    if client_id:
+        body["client_id"] = client_id
+    r = _SESSION.post(
+        f"{COMFY_BASE}/prompt",
+        data=orjson.dumps(body),
+        headers={"Content-Type": "application/json"},
+        timeout=60,
+    )
     r.raise_for_status()
-    return r.json()["prompt_id"]
+    return orjson.loads(r.content)["prompt_id"]
+
+
+def comfy_interrupt() -> None:
+    """Drop everything still pending in the ComfyUI queue and stop the running prompt; failures are non-fatal."""
+    try:
+        _SESSION.post(f"{COMFY_BASE}/queue", data=orjson.dumps({"clear": True}),
+                      headers={"Content-Type": "application/json"}, timeout=5)
+        _SESSION.post(f"{COMFY_BASE}/interrupt", timeout=5)
+    except Exception:
+        pass
 
 
 def comfy_get_history(prompt_id: str) -> dict:
-    r = requests.get(f"{COMFY_BASE}/history/{prompt_id}", timeout=60)
+    r = _SESSION.get(f"{COMFY_BASE}/history/{prompt_id}", timeout=60)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def wait_until_done(prompt_id: str, timeout_sec: int = 3600, poll: float = 1.0) -> dict:
+def wait_until_done(prompt_id: str, timeout_sec: int = 3600, poll: float = 0.1, max_poll: float = 2.0) -> dict:
+    """Poll /history with exponential backoff (0.1 s -> 2 s); fallback when the WebSocket is unavailable."""
     t0 = time.time()
     while True:
         hist = comfy_get_history(prompt_id)
@@ -225,10 +579,83 @@ def wait_until_done(prompt_id: str, timeout_sec: int = 3600, poll: float = 1.0)
             if status.get("completed", False) or status.get("status_str") == "success":
                 return hist[prompt_id]
             if status.get("status_str") == "error":
-                raise RuntimeError(f"ComfyUI error: {json.dumps(status, ensure_ascii=False)}")
+                raise RuntimeError(f"ComfyUI error: {orjson.dumps(status).decode()}")
         if time.time() - t0 > timeout_sec:
             raise TimeoutError(f"ComfyUI job timeout after {timeout_sec}s, prompt_id={prompt_id}")
         time.sleep(poll)
+        poll = min(poll * 1.5, max_poll)
+
+
+def wait_ws_done(ws: websocket.WebSocket, prompt_id: str, timeout_sec: int) -> bool:
+    """
+    Block on ComfyUI push events until prompt_id finishes (executing with node=None).
+    Returns False if the socket drops, so the caller can fall back to polling.
+    """
+    deadline = time.time() + timeout_sec
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError(f"ComfyUI job timeout after {timeout_sec}s, prompt_id={prompt_id}")
+        ws.settimeout(remaining)
+        try:
+            raw = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            raise TimeoutError(f"ComfyUI job timeout after {timeout_sec}s, prompt_id={prompt_id}")
+        except Exception:
+            return False
+        if not isinstance(raw, str):
+            continue  # binary preview frames
+        try:
+            msg = orjson.loads(raw)
+        except Exception:
+            continue
+        data = msg.get("data") or {}
+        if data.get("prompt_id") != prompt_id:
+            continue
+        mtype = msg.get("type")
+        if mtype == "executing" and data.get("node") is None:
+            return True
+        if mtype in ("execution_error", "execution_interrupted"):
+            raise RuntimeError(f"ComfyUI error: {orjson.dumps(data).decode()}")
+
+
+def run_prompt(prompt: dict, timeout_sec: int) -> Tuple[str, dict]:
+    """
+    Submit prompt and wait for completion via WebSocket events.
+    One /history call afterwards fetches the final status; history polling is the fallback.
+    """
+    # 整个 run 共用一个 deadline：WebSocket 中途断开后，轮询只拿剩余时间（否则最长可达 2× timeout_sec）
+    deadline = time.time() + timeout_sec
+    client_id = uuid.uuid4().hex
+    ws = comfy_connect_ws(client_id)
+    try:
+        prompt_id = comfy_post_prompt(prompt, client_id=client_id)
+        if ws is not None:
+            wait_ws_done(ws, prompt_id, timeout_sec=max(deadline - time.time(), 0))
+        return prompt_id, wait_until_done(prompt_id, timeout_sec=max(deadline - time.time(), 0))
+    finally:
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+
+def pick_mp4_from_history(result: dict, prefix: str) -> Optional[str]:
+    """Exact output path from ComfyUI history `outputs` (VHS_VideoCombine reports files under "gifs")."""
+    for node_out in (result.get("outputs") or {}).values():
+        for items in node_out.values():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                if not isinstance(item, dict) or item.get("type", "output") != "output":
+                    continue
+                fn = item.get("filename") or ""
+                if fn.startswith(prefix) and fn.lower().endswith(".mp4"):
+                    p = os.path.join(COMFY_OUTPUT_DIR, item.get("subfolder") or "", fn)
+                    if os.path.isfile(p):
+                        return p
+    return None
 
 
 def find_latest_output(prefix: str) -> str:
@@ -275,58 +702,56 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
     params = inp.get("params") or {}
     timeout_sec = int(params.get("timeout_sec", 3600))
 
-    workdir = f"/tmp/jobs/{job_id}"
+    s3 = _get_s3()
+
+    # 输入 + 预处理输出 + 余量
+    input_size = s3.head_object(Bucket=S3_BUCKET, Key=input_key)["ContentLength"]
+    workdir = os.path.join(pick_jobs_root(input_size * 3), job_id)
     os.makedirs(workdir, exist_ok=True)
 
     local_in = os.path.join(workdir, "in.mp4")
     local_pre = os.path.join(workdir, "in_pre.mp4")
 
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_KEY_ID,
-        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-    )
-
     t0 = time.time()
     try:
-        # 1) Download from R2
-        s3.download_file(S3_BUCKET, input_key, local_in)
+        # 1) Download from R2；同时读取 workflow、预热 ComfyUI 连接（互不依赖的 IO 并行）
+        wf_fut = _EX.submit(_get_workflow)
+        _EX.submit(comfy_ping)
+
+        # 可选：需要降帧时直接从 URL 边下边转码（此时 download 计时包含转码）
+        pre_info, probe = None, None
+        if PREPROCESS_STREAMING:
+            pre_info, probe = stream_preprocess(s3, S3_BUCKET, input_key, local_pre,
+                                                fps_cap=FPS_CAP, max_seconds=MAX_SECONDS)
+        if pre_info is None:
+            download_ranged(s3, S3_BUCKET, input_key, local_in, size=input_size)
+        wf_template, wf_patches = wf_fut.result()
         t_dl = time.time()
 
         # 2) Preprocess with fixed rules
-        pre_info = preprocess_video(local_in, local_pre, fps_cap=FPS_CAP, max_seconds=MAX_SECONDS)
+        if pre_info is None:
+            pre_info = preprocess_video(local_in, local_pre, fps_cap=FPS_CAP, max_seconds=MAX_SECONDS, probe=probe)
         input_path_for_comfy = pre_info["path"]
         t_pre = time.time()
 
-        # 3) Load workflow and replace placeholders
-        with open(WORKFLOW_PATH, "r", encoding="utf-8") as f:
-            wf = json.load(f)
-
+        # 3) Replace placeholders (workflow 已在下载阶段预读)
         prefix = f"job_{job_id}"
-        wf = deep_replace(wf, {
+        wf = apply_patches(wf_template, wf_patches, {
             "__INPUT_VIDEO__": input_path_for_comfy,
             "__OUTPUT_PREFIX__": prefix,
         })
         t_wf = time.time()
 
         # 4) Run ComfyUI
-        prompt_id = comfy_post_prompt(wf)
-        result = wait_until_done(prompt_id, timeout_sec=timeout_sec)
+        prompt_id, result = run_prompt(wf, timeout_sec=timeout_sec)
         t_comfy = time.time()
 
-        # 5) Upload output
-        out_local = find_latest_output(prefix)
-        s3.upload_file(out_local, S3_BUCKET, output_key)
-        t_up = time.time()
+        # 5) Upload output：后台上传，同时清理输入文件、组装返回
+        out_local = pick_mp4_from_history(result, prefix) or find_latest_output(prefix)
+        up_fut = _EX.submit(s3.upload_file, out_local, S3_BUCKET, output_key, Config=_TC)
+        cleanup_workdir(workdir, (local_in, local_pre))
 
-        # 可选：删输出，避免 /comfyui/output 越跑越大（你也可以注释掉）
-        try:
-            os.remove(out_local)
-        except Exception:
-            pass
-
-        return {
+        resp = {
             "job_id": job_id,
             "input_key": input_key,
             "output_key": output_key,
@@ -337,14 +762,74 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
                 "preprocess": round(t_pre - t_dl, 3),
                 "workflow_prepare": round(t_wf - t_pre, 3),
                 "comfy_run": round(t_comfy - t_wf, 3),
-                "upload": round(t_up - t_comfy, 3),
-                "total": round(t_up - t0, 3),
             },
             "comfy_status": result.get("status", {}),
         }
 
+        up_fut.result()
+        t_up = time.time()
+        resp["timing_sec"]["upload"] = round(t_up - t_comfy, 3)
+        resp["timing_sec"]["total"] = round(t_up - t0, 3)
+
+        # 可选：删输出，避免 /comfyui/output 越跑越大（你也可以注释掉）
+        try:
+            os.remove(out_local)
+        except Exception:
+            pass
+
+        return resp
+
+    finally:
+        cleanup_workdir(workdir, (local_in, local_pre))
+
+
+# -----------------------------
+# Warm-up
+# -----------------------------
+def warmup():
+    """
+    Run the production workflow once on a 1 s synthetic clip before accepting jobs.
+    ComfyUI caches loader outputs across prompts, so model/T5/VAE/detector weights stay loaded
+    and the first real job skips checkpoint loading. Failures are logged and ignored.
+    """
+    workdir = "/tmp/jobs/_warmup"
+    prefix = "warmup_"
+    os.makedirs(workdir, exist_ok=True)
+    src = os.path.join(workdir, "warmup.mp4")
+    t0 = time.time()
+    try:
+        run_ffmpeg([
+            "-f", "lavfi", "-i", "testsrc=size=320x240:rate=5:duration=1",
+            "-f", "lavfi", "-i", "sine=duration=1",
+            "-c:v", "libx264", "-pix_fmt", "yuv420p",
+            "-c:a", "aac",
+            "-shortest",
+            src
+        ])
+        wf_template, wf_patches = _get_workflow()
+        wf = apply_patches(wf_template, wf_patches, {
+            "__INPUT_VIDEO__": src,
+            "__OUTPUT_PREFIX__": prefix,
+        })
+        run_prompt(wf, timeout_sec=WARMUP_TIMEOUT_SEC)
+        print(f"[WARMUP] done in {time.time() - t0:.1f}s", flush=True)
+    except Exception as e:
+        # 预热超时/出错时 prompt 可能还在 ComfyUI 里跑或排队，第一个真实 job 会排在它后面 -> 清掉
+        # （预热在 serverless.start 之前执行，此时队列里只有预热 prompt）
+        comfy_interrupt()
+        print(f"[WARMUP] skipped: {e}", flush=True)
     finally:
         shutil.rmtree(workdir, ignore_errors=True)
+        if os.path.isdir(COMFY_OUTPUT_DIR):
+            for fn in os.listdir(COMFY_OUTPUT_DIR):
+                if fn.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(COMFY_OUTPUT_DIR, fn))
+                    except Exception:
+                        pass
+
 
+if COMFY_WARMUP:
+    warmup()
 
 runpod.serverless.start({"handler": handler})
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+import install_custom_nodes as icn  # noqa: E402
+
+
+def git(*args, cwd=None):
+    return subprocess.run(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", *args],
+        cwd=cwd, check=True, capture_output=True, text=True,
+    ).stdout.strip()
+
+
+class IterSpecsTest(unittest.TestCase):
+    def parse(self, text):
+        with tempfile.NamedTemporaryFile("wb", suffix=".txt", delete=False) as f:
+            f.write(text)
+        self.addCleanup(os.unlink, f.name)
+        return list(icn.iter_specs(f.name))
+
+    def test_skips_blanks_and_comments(self):
+        specs = self.parse(b"# pinned\n\n  https://x/a.git|abc \n  # https://x/c|def\nhttps://x/b|def|paths=n,m\r\n")
+        self.assertEqual(specs, [("https://x/a.git", "abc", None), ("https://x/b", "def", ("n", "m"))])
+
+    def test_malformed_line_raises_with_line_number(self):
+        for bad in (b"https://x/a.git abc\n", b"https://x/a.git|abc|nodes\n"):
+            with self.assertRaisesRegex(ValueError, r":2: malformed lock line"):
+                self.parse(b"https://x/b|def\n" + bad)
+
+
+@unittest.skipUnless(shutil.which("git"), "git not available")
+class SparseLockEntryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        # 源仓库允许 filter / 按 sha fetch，blob:none 才真正生效（file:// 默认会忽略 filter）
+        self.src = os.path.join(self.tmp, "node")
+        os.makedirs(os.path.join(self.src, "nodes"))
+        os.makedirs(os.path.join(self.src, "docs"))
+        for rel, body in [("nodes/n.py", "a\n"), ("docs/big.txt", "b\n"), ("requirements.txt", "r\n")]:
+            with open(os.path.join(self.src, rel), "w") as f:
+                f.write(body)
+        git("init", "-q", cwd=self.src)
+        git("config", "uploadpack.allowFilter", "true", cwd=self.src)
+        git("config", "uploadpack.allowAnySHA1InWant", "true", cwd=self.src)
+        git("add", "-A", cwd=self.src)
+        git("commit", "-qm", "init", cwd=self.src)
+        self.commit = git("rev-parse", "HEAD", cwd=self.src)
+
+        self.installed = []
+        self.checkouts = []
+
+        async def fake_pip_install(reqs):
+            self.installed.extend(reqs)
+
+        checkout_pinned = icn.checkout_pinned
+
+        async def counting_checkout(repo, target, commit, *args):
+            self.checkouts.append(commit)
+            await checkout_pinned(repo, target, commit, *args)
+
+        self._pip_install, icn.pip_install = icn.pip_install, fake_pip_install
+        self.addCleanup(setattr, icn, "pip_install", self._pip_install)
+        icn.checkout_pinned = counting_checkout
+        self.addCleanup(setattr, icn, "checkout_pinned", checkout_pinned)
+
+        self.dst = os.path.join(self.tmp, "custom_nodes")
+        self.target = os.path.join(self.dst, "node")
+
+    def install(self, commit, extra=""):
+        lock = os.path.join(self.tmp, "lock.txt")
+        with open(lock, "w") as f:
+            f.write(f"file://{self.src}|{commit}{extra}\n")
+        # 去掉整体指纹，让重跑真正走 is_at_commit / sparse 对齐 / 哨兵判断
+        try:
+            os.remove(os.path.join(self.dst, ".lock-digest"))
+        except FileNotFoundError:
+            pass
+        self.installed.clear()
+        self.checkouts.clear()
+        asyncio.run(icn.main_async(lock, self.dst))
+
+    def present(self, rel):
+        return os.path.exists(os.path.join(self.target, rel))
+
+    def test_paths_entry_checks_out_only_the_cone(self):
+        self.install(self.commit, "|paths=nodes")
+        self.assertTrue(self.present("nodes/n.py"))
+        self.assertTrue(self.present("requirements.txt"))
+        self.assertFalse(self.present("docs"))
+        self.assertEqual(self.installed, [os.path.join(self.target, "requirements.txt")])
+        self.assertEqual(self.checkouts, [self.commit])
+
+        # 重跑：已在该 commit、依赖已装 -> 不再 checkout / pip
+        self.install(self.commit, "|paths=nodes")
+        self.assertEqual(self.checkouts, [])
+        self.assertEqual(self.installed, [])
+        self.assertFalse(self.present("docs"))
+
+    def test_changed_or_removed_paths_update_existing_clone(self):
+        self.install(self.commit, "|paths=nodes")
+
+        self.install(self.commit, "|paths=docs")
+        self.assertTrue(self.present("docs/big.txt"))
+        self.assertFalse(self.present("nodes"))
+
+        # 去掉 paths 同时换 commit：恢复完整检出
+        with open(os.path.join(self.src, "nodes", "m.py"), "w") as f:
+            f.write("c\n")
+        git("add", "-A", cwd=self.src)
+        git("commit", "-qm", "bump", cwd=self.src)
+        bumped = git("rev-parse", "HEAD", cwd=self.src)
+        self.install(bumped)
+        self.assertEqual(self.checkouts, [bumped])
+        for rel in ("nodes/n.py", "nodes/m.py", "docs/big.txt", "requirements.txt"):
+            self.assertTrue(self.present(rel), rel)
+        self.assertEqual(git("config", "--bool", "core.sparseCheckout", cwd=self.target), "false")
+
+        # 换 commit 后只剩新哨兵，工作区无未跟踪文件
+        self.assertEqual(self.installed, [os.path.join(self.target, "requirements.txt")])
+        sentinels = [n for n in os.listdir(os.path.join(self.target, ".git")) if n.startswith("installed-")]
+        self.assertEqual(len(sentinels), 1)
+        self.assertIn(bumped, sentinels[0])
+        self.assertEqual(git("status", "--porcelain", cwd=self.target), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
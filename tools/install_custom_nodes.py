@@ -1,34 +1,403 @@
-import argparse, os, subprocess
+import argparse, asyncio, hashlib, json, logging, os, re, shutil, subprocess
 
-def run(cmd, cwd=None):
-    print("+", " ".join(cmd), flush=True)
-    subprocess.check_call(cmd, cwd=cwd)
+try:
+    import pygit2  # 可选：libgit2 进程内完成 fetch/checkout，省掉 git 子进程
+except ImportError:
+    pygit2 = None
+
+log = logging.getLogger("install_custom_nodes")
+
+PYTHON = "/opt/venv/bin/python"
+# 共享 wheel 缓存（大的 CUDA/torch 周边 wheel 不必每次重新下载）；Dockerfile 里以 cache mount 挂载
+PIP_CACHE_DIR = os.environ.get("PIP_CACHE_DIR", "/opt/pip-cache")
+# uv（并行解析/下载，全局内容寻址缓存）优先；不可用或失败时回退 pip
+UV = "/opt/venv/bin/uv"
+UV_CACHE_DIR = os.environ.get("UV_CACHE_DIR", "/opt/uv-cache")
+# 预先 pip download 好的本地 wheel 目录；存在时先只用二进制 wheel 安装，杜绝源码编译回退
+WHEELHOUSE = os.environ.get("WHEELHOUSE", "/opt/wheelhouse")
+
+# 外层并发（仓库数）× 内层 git 线程（delta 解析/打包）≈ CPU 数，避免过度订阅
+CPUS = os.cpu_count() or 1
+WORKERS = max(1, int(os.environ.get("INSTALL_PARALLEL", max(2, CPUS // 2))))
+GIT_THREADS = max(1, CPUS // WORKERS)
+GIT_PERF = ["-c", f"pack.threads={GIT_THREADS}", "-c", f"index.threads={GIT_THREADS}"]
+FETCH_OPTS = ["-c", "protocol.version=2", "-c", "fetch.parallel=0"]
+# 写进每个节点仓库的配置（"Git Much Faster" 一套）：协议 v2、跳跃式协商、commit-graph、manyFiles 索引
+REPO_CONFIG = {
+    "protocol.version": "2",
+    "fetch.negotiationAlgorithm": "skipping",
+    "core.commitGraph": "true",
+    "gc.writeCommitGraph": "true",
+    "feature.manyFiles": "true",
+    "core.untrackedCache": "true",
+    "index.version": "4",
+    "pack.useSparse": "true",
+}
+
+# lock 行：repo|commit[|paths=a,b]。bytes 正则，省掉逐行 decode + 多次 strip/split
+LOCK_LINE = re.compile(rb"^\s*([^#\s|][^|\s]*)\|([^|\s]+)(?:\|paths=(\S*))?\s*$")
+
+# 网络抖动类失败（git / pip / uv 输出）才重试；其余错误（sha 不存在、依赖冲突）立即抛出，交给调用方回退
+TRANSIENT = re.compile(
+    r"fatal: unable to access|Connection reset|Could not resolve host|HTTP error 5\d\d"
+    r"|remote end hung up unexpectedly|Read timed out"
+)
+
+# 写共享对象库的操作串行化（同时 fetch 进同一个 bare 仓库会抢 ref/shallow 锁）；在 main_async 里创建
+_SHARED_LOCK = None
+
+async def run(cmd, cwd=None, env=None, retries=3, backoff=2.0):
+    for i in range(retries):
+        # 单线程 asyncio 同时挂起多个 git 子进程；整段收集输出、一次性写日志，避免多个仓库的输出交错
+        p = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        try:
+            raw, _ = await p.communicate()
+        except asyncio.CancelledError:
+            # 别的仓库失败导致本任务被取消：连同 git/pip 子进程一起结束，不留孤儿进程
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+            raise
+        out = raw.decode(errors="replace").rstrip()
+        log.info("+ %s%s", " ".join(cmd), ("\n" + out) if out else "")
+        if p.returncode == 0:
+            return
+        if i == retries - 1 or not TRANSIENT.search(out):
+            raise subprocess.CalledProcessError(p.returncode, cmd, output=out)
+        # asyncio.sleep：退避期间其它仓库照常进行
+        delay = backoff ** i
+        log.info("~ transient failure, retrying in %.1fs (%d/%d)", delay, i + 1, retries - 1)
+        await asyncio.sleep(delay)
+
+async def git_output(target, *args):
+    """stdout of a read-only git query in target, or None if it fails (not logged: these run on every re-run)."""
+    try:
+        p = await asyncio.create_subprocess_exec(
+            "git", *args, cwd=target, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None
+    out, _ = await p.communicate()
+    return out.decode().strip() if p.returncode == 0 else None
+
+async def head_commit(target):
+    if pygit2 is not None:
+        try:
+            return str(pygit2.Repository(target).head.target)
+        except Exception:
+            pass
+    return await git_output(target, "rev-parse", "HEAD")
+
+async def is_at_commit(target, commit):
+    # --no-checkout 的克隆没有 index：HEAD 恰好等于 commit 也不算已检出
+    if not os.path.exists(os.path.join(target, ".git", "index")):
+        return False
+    return await head_commit(target) == commit
+
+async def init_shared_store(shared):
+    """Bare repo whose object db every node clone borrows from via objects/info/alternates."""
+    if not os.path.isdir(os.path.join(shared, "objects")):
+        await run(["git", "init", "--bare", "-q", shared])
+    return shared
+
+def link_alternates(target, shared):
+    alt = os.path.join(target, ".git", "objects", "info", "alternates")
+    objects = os.path.join(os.path.abspath(shared), "objects")
+    existing = open(alt, encoding="utf-8").read().split() if os.path.exists(alt) else []
+    if objects not in existing:
+        os.makedirs(os.path.dirname(alt), exist_ok=True)
+        with open(alt, "a", encoding="utf-8") as f:
+            f.write(objects + "\n")
+
+async def share_objects(target, name, shared):
+    """Publish target's objects into the shared store, then drop local copies the store already has."""
+    async with _SHARED_LOCK:
+        await run(["git", "-C", shared, "fetch", "-q", "--no-tags", "--depth", "1", os.path.abspath(target),
+             f"+HEAD:refs/nodes/{name}"])
+    await run(["git", "-C", target] + GIT_PERF + ["repack", "-a", "-d", "-l", "-q"])
+
+def _pygit2_checkout(repo, target, commit, shared):
+    """libgit2 in-process: init + shallow fetch of the sha + detached checkout, no git subprocesses."""
+    if os.path.isdir(os.path.join(target, ".git")):
+        r = pygit2.Repository(target)
+    else:
+        r = pygit2.init_repository(target)
+        for k, v in REPO_CONFIG.items():
+            r.config[k] = v
+        r.remotes.create("origin", repo)
+        link_alternates(target, shared)
+    log.info("+ pygit2 fetch --depth 1 origin %s (%s)", commit, target)
+    r.remotes["origin"].fetch([commit], depth=1)
+    obj = r.get(commit)
+    r.checkout_tree(obj)
+    r.set_head(obj.id)
+
+async def sparse_checkout(target, paths):
+    # cone 模式：根目录文件（requirements.txt、__init__.py）总会检出，另外只物化列出的目录
+    await run(["git", "sparse-checkout", "init", "--cone"], cwd=target)
+    await run(["git", "sparse-checkout", "set"] + list(paths), cwd=target)
+
+async def sync_sparse(target, paths):
+    """Bring an existing checkout's sparse cone in line with the lock: set when paths changed, disable when dropped."""
+    enabled = await git_output(target, "config", "--bool", "core.sparseCheckout") == "true"
+    if not paths:
+        if enabled:
+            await run(["git", "sparse-checkout", "disable"], cwd=target)
+        return
+    if enabled:
+        current = (await git_output(target, "sparse-checkout", "list") or "").split()
+        if sorted(current) == sorted(p.strip("/") for p in paths):
+            return
+    await sparse_checkout(target, paths)
+
+async def _cli_checkout(repo, target, commit, shared, paths=None):
+    if not os.path.isdir(os.path.join(target, ".git")):
+        # 只拿一个 commit：浅克隆 + 不带 blob，按 sha 精确 fetch；对象库借用共享库
+        # clone --config 直接写入新仓库配置，不必再逐条 git config
+        repo_config = [arg for k, v in REPO_CONFIG.items() for arg in ("--config", f"{k}={v}")]
+        await run(["git"] + GIT_PERF + ["clone", "--reference-if-able", shared]
+                  + repo_config + ["--filter=blob:none", "--no-checkout", "--depth", "1"]
+                  + (["--sparse"] if paths else []) + [repo, target])
+        if paths:
+            await sparse_checkout(target, paths)
+    try:
+        await run(["git"] + GIT_PERF + FETCH_OPTS + ["fetch", "--depth", "1", "--no-tags", "origin", commit], cwd=target)
+    except subprocess.CalledProcessError:
+        # 服务端不允许按 sha fetch（uploadpack.allowReachableSHA1InWant 关闭）-> 拉取分支历史后再检出该 commit
+        deepen = ["--unshallow"] if os.path.exists(os.path.join(target, ".git", "shallow")) else []
+        await run(["git"] + GIT_PERF + FETCH_OPTS + ["fetch", "--no-tags"] + deepen + ["origin"], cwd=target)
+    await run(["git", "checkout", "--detach", commit], cwd=target)
+
+async def checkout_pinned(repo, target, commit, shared, paths=None):
+    # libgit2 不支持 sparse-checkout -> 指定了 paths 的仓库直接走 git CLI
+    if pygit2 is not None and not paths:
+        try:
+            # libgit2 调用是阻塞的 -> 放到线程里，不卡住事件循环
+            await asyncio.to_thread(_pygit2_checkout, repo, target, commit, shared)
+            return
+        except Exception as e:
+            log.info("~ pygit2 failed for %s (%s); falling back to git CLI", target, e)
+    await _cli_checkout(repo, target, commit, shared, paths)
+
+async def _install(args, uv_extra=(), pip_extra=()):
+    uv = UV if os.path.exists(UV) else shutil.which("uv")
+    if uv:
+        try:
+            # cache mount 与 venv 不在同一文件系统，硬链接不可用 -> copy
+            await run([uv, "pip", "install", "--python", PYTHON, "--cache-dir", UV_CACHE_DIR] + list(uv_extra) + args,
+                env=dict(os.environ, UV_LINK_MODE="copy"))
+            return
+        except subprocess.CalledProcessError:
+            log.info("~ uv pip install failed; falling back to pip")
+    await run([PYTHON, "-m", "pip", "install"] + list(pip_extra) + args,
+        env=dict(os.environ, PIP_CACHE_DIR=PIP_CACHE_DIR))
+
+async def pip_install(reqs):
+    """One install for all requirement files: uv when present, else (or if uv fails) pip."""
+    args = []
+    for r in reqs:
+        args += ["-r", r]
+    if os.path.isdir(WHEELHOUSE):
+        try:
+            await _install(
+                args,
+                uv_extra=["--only-binary", ":all:", "--find-links", WHEELHOUSE],
+                pip_extra=["--prefer-binary", "--only-binary=:all:", "--find-links", WHEELHOUSE],
+            )
+            return
+        except subprocess.CalledProcessError:
+            # 有包只有 sdist / wheelhouse 缺版本（ResolutionImpossible 等）-> 不加限制再装一次
+            log.info("~ binary-only install from %s failed; retrying unconstrained", WHEELHOUSE)
+    await _install(args)
+
+def parse_paths(value: str):
+    """Value of the optional third lock column `paths=a,b,c` -> ("a", "b", "c"); None means full checkout."""
+    return tuple(p for p in value.split(",") if p) or None
+
+def iter_specs(lock_path: str):
+    """
+    Yield (repo, commit, paths) per lock line, lazily, skipping blanks and comments.
+    Any other line that is not repo|commit[|paths=...] raises ValueError with its line number.
+    """
+    with open(lock_path, "rb") as f:
+        for lineno, raw in enumerate(f, 1):
+            m = LOCK_LINE.match(raw)
+            if not m:
+                # 只在不匹配时才 strip：空行 / 注释跳过，其它（如 "repo sha" 少了 |）必须报错，不能静默丢节点
+                s = raw.strip()
+                if not s or s.startswith(b"#"):
+                    continue
+                raise ValueError(
+                    f"{lock_path}:{lineno}: malformed lock line {s.decode(errors='replace')!r}"
+                    " (expected repo|commit[|paths=a,b])"
+                )
+            repo, commit, extra = m.groups()
+            yield repo.decode(), commit.decode(), parse_paths(extra.decode()) if extra else None
+
+def repo_name(repo: str) -> str:
+    return repo.rstrip("/").split("/")[-1].replace(".git", "")
+
+def dedupe_specs(specs):
+    """
+    One entry per target name, so every <dst>/<name> is created by exactly one task
+    -> [(name, repo, commit, paths)]. The last lock line for a name wins, as when every line was
+    checked out in turn; superseded commits are dropped with a warning instead of being materialised.
+    """
+    latest = {}
+    for repo, commit, paths in specs:
+        name = repo_name(repo)
+        prev = latest.get(name)
+        if prev is not None and prev[1] != commit:
+            log.warning("~ %s: %s superseded by %s later in the lock; dropping it", name, prev[1], commit)
+        latest[name] = (repo, commit, paths)
+    return [(name,) + spec for name, spec in latest.items()]
+
+def requirements_state(target, name, commit):
+    """(name, requirements.txt, sentinel, installed) for a checkout with requirements, else None."""
+    req = os.path.join(target, "requirements.txt")
+    # 直接 open：一次系统调用，不再先 exists() 再 open()
+    try:
+        with open(req, "rb") as f:
+            h = hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+    # 哨兵 = commit + requirements 内容指纹：pip 成功后写入；两者都没变 -> 跳过 pip
+    # 放在 .git/ 下：不在工作区里留未跟踪文件
+    sentinel = os.path.join(target, ".git", f"installed-{commit}-{h[:16]}")
+    installed = os.path.exists(sentinel)
+    if installed:
+        log.info("= %s requirements already installed", name)
+    return name, req, sentinel, installed
+
+def mark_installed(sentinel):
+    """Write sentinel and drop the ones left by earlier commits / requirements (incl. old work-tree .installed-*)."""
+    git_dir = os.path.dirname(sentinel)
+    for d, prefix in ((git_dir, "installed-"), (os.path.dirname(git_dir), ".installed-")):
+        with os.scandir(d) as it:
+            for e in it:
+                if e.name.startswith(prefix) and e.path != sentinel:
+                    os.remove(e.path)
+    open(sentinel, "w").close()
+
+def write_manifest(dst, states):
+    """<dst>/.install-manifest.json: name -> sentinel (relative to dst), for auditing what got installed."""
+    path = os.path.join(dst, ".install-manifest.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest.update({name: os.path.relpath(sentinel, dst) for name, _, sentinel, _ in states})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+async def process_repo(spec, dst: str, shared: str, existing=frozenset()):
+    """
+    clone/fetch/checkout one repo at <dst>/<name>. Returns [requirements_state()] if it has requirements.
+    `existing` is the snapshot of names already under dst; anything else is known to need a fresh checkout.
+    """
+    name, repo, commit, paths = spec
+    target = os.path.join(dst, name)
+
+    # 已有克隆：lock 里的 paths 可能改了或删了（clone 时的 sparse 设置不会自己更新）-> 每次都对齐
+    cloned = name in existing and os.path.isdir(os.path.join(target, ".git"))
+    if cloned and await is_at_commit(target, commit):
+        log.info("= %s already at %s", name, commit)
+        await sync_sparse(target, paths)
+    else:
+        await checkout_pinned(repo, target, commit, shared, paths)
+        if cloned:
+            await sync_sparse(target, paths)
+        if paths:
+            # sparse + blob:none 的克隆缺 cone 外的 blob，upload-pack 无法打包 HEAD -> 不发布到共享库
+            log.info("~ %s is sparse; not publishing its objects to the shared store", name)
+        else:
+            try:
+                await share_objects(target, name, shared)
+            except subprocess.CalledProcessError:
+                # 共享库只是去重优化：失败不影响该节点可用，不拖垮整次安装
+                log.info("~ %s: publishing objects to the shared store failed; keeping local copies", name)
+
+    state = requirements_state(target, name, commit)
+    return [state] if state else []
+
+def lock_digest(lock_path: str) -> str:
+    with open(lock_path, "rb") as f:
+        return hashlib.blake2b(f.read()).hexdigest()
+
+def read_marker(path: str):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+async def main_async(lock_path: str, dst: str, shared: str = None):
+    global _SHARED_LOCK
+    _SHARED_LOCK = asyncio.Lock()
 
-def main(lock_path: str, dst: str):
     os.makedirs(dst, exist_ok=True)
+    # 启动时一次 scandir 拿到已存在的目录名（只读快照，各任务共享），新仓库不再逐个 stat
+    with os.scandir(dst) as it:
+        existing = frozenset(e.name for e in it)
 
-    with open(lock_path, "r", encoding="utf-8") as f:
-        lines = [x.strip() for x in f if x.strip() and not x.strip().startswith("#")]
+    # 共享对象库放在 dst 外面：custom_nodes 下的每个目录都会被 ComfyUI 当成节点包去 import
+    shared = shared or os.path.join(os.path.dirname(os.path.abspath(dst)), ".custom_nodes-objects")
 
-    for line in lines:
-        repo, commit = line.split("|", 1)
-        name = repo.rstrip("/").split("/")[-1].replace(".git", "")
-        target = os.path.join(dst, name)
+    # 整个 lock 文件的指纹：上次成功时写入 <dst>/.lock-digest；没变且节点目录、
+    # 共享对象库（各仓库通过 alternates 借用其对象，删了仓库就坏了）都在 -> 直接返回
+    digest = lock_digest(lock_path)
+    marker = os.path.join(dst, ".lock-digest")
+    specs = dedupe_specs(iter_specs(lock_path))
+    if (
+        read_marker(marker) == digest
+        and os.path.isdir(os.path.join(shared, "objects"))
+        and all(spec[0] in existing for spec in specs)
+    ):
+        log.info("= %s up-to-date", lock_path)
+        return
 
-        if not os.path.exists(target):
-            run(["git", "clone", repo, target, "--no-checkout"])
+    shared = await init_shared_store(shared)
 
-        run(["git", "fetch", "--all"], cwd=target)
-        run(["git", "checkout", commit], cwd=target)
+    # git 部分互相独立、以网络 IO 为主 -> 并发（Semaphore 限制同时在跑的仓库数）
+    sem = asyncio.Semaphore(WORKERS)
 
-        req = os.path.join(target, "requirements.txt")
-        if os.path.exists(req):
-            run(["/opt/venv/bin/python", "-m", "pip", "install", "--no-cache-dir", "-r", req])
+    async def bounded(spec):
+        async with sem:
+            return await process_repo(spec, dst, shared, existing)
+
+    # 同名仓库只克隆一次（lock 里靠后的条目生效）
+    tasks = [asyncio.create_task(bounded(spec)) for spec in specs]
+    try:
+        states = [x for xs in await asyncio.gather(*tasks) for x in xs]
+    except BaseException:
+        # 一个仓库失败 -> 取消其余任务并等它们杀掉各自的子进程，再把原异常抛出去
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    pending = [st for st in states if not st[3]]
+
+    # 所有 requirements 合并成一次安装（git 全部结束后串行执行）：只启动/解析一次，共享依赖只下载一次
+    if pending:
+        await pip_install([req for _, req, _, _ in pending])
+        for _, _, sentinel, _ in pending:
+            mark_installed(sentinel)
+    write_manifest(dst, states)
+    # 最后写：中途失败则下次完整重跑
+    with open(marker, "w", encoding="utf-8") as f:
+        f.write(digest)
+
+def main(lock_path: str, dst: str, shared: str = None):
+    asyncio.run(main_async(lock_path, dst, shared))
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     ap = argparse.ArgumentParser()
     ap.add_argument("--lock", required=True)
     ap.add_argument("--dst", required=True)
+    ap.add_argument("--shared", default=None, help="shared git object store (default: <dst>/../.custom_nodes-objects)")
     args = ap.parse_args()
-    main(args.lock, args.dst)
-
+    main(args.lock, args.dst, args.shared)